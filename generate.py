@@ -1,4 +1,8 @@
+import copy
+import string
 import sys
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from typing import overload
 
 from crossword import *
@@ -10,10 +14,43 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+
+        # Group words by length once, so every domain starts out
+        # node-consistent instead of holding the whole vocabulary
+        words_by_length = defaultdict(set)
+        for word in self.crossword.words:
+            words_by_length[len(word)].add(word)
         self.domains = {
-            var: self.crossword.words.copy()
+            var: words_by_length[var.length].copy()
+            for var in self.crossword.variables
+        }
+        # Neighbors and overlaps never change, so look them up once
+        self._neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
             for var in self.crossword.variables
         }
+        self._overlap = dict(self.crossword.overlaps)
+
+        # Tuple copies of domains for fast iteration, rebuilt only for
+        # variables whose domain changed since the last copy
+        self._dom_cache = dict()
+        self._dom_dirty = set(self.crossword.variables)
+
+        # Per-variable index of domain words by (position, letter),
+        # built lazily and dropped whenever the variable's domain changes
+        self._letter_index = dict()
+        # Last known supporting y value for each x value, per arc (x, y),
+        # as in AC-3rm
+        self.residual = dict()
+        # (variable, word) pairs removed from domains, so that the removals
+        # made while exploring an assignment can be undone on backtrack
+        self.trail = []
+        # Assigned variables in search order, each with whether its
+        # propagation pruned any domain
+        self.segments = []
+        # Variables blamed for the values of each variable that failed,
+        # used for conflict-directed backjumping
+        self.conf_set = dict()
 
     def letter_grid(self, assignment):
         """
@@ -29,11 +66,10 @@ class CrosswordCreator():
                 letters[i][j] = word[k]
         return letters
 
-    def print(self, assignment):
+    def print(self, letters):
         """
-        Print crossword assignment to the terminal.
+        Print crossword letter grid from `letter_grid` to the terminal.
         """
-        letters = self.letter_grid(assignment)
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
                 if self.crossword.structure[i][j]:
@@ -42,15 +78,14 @@ class CrosswordCreator():
                     print("█", end="")
             print()
 
-    def save(self, assignment, filename):
+    def save(self, letters, filename):
         """
-        Save crossword assignment to an image file.
+        Save crossword letter grid from `letter_grid` to an image file.
         """
         from PIL import Image, ImageDraw, ImageFont
         cell_size = 100
         cell_border = 2
         interior_size = cell_size - 2 * cell_border
-        letters = self.letter_grid(assignment)
 
         # Create a blank canvas
         img = Image.new("RGBA", (self.crossword.width * cell_size,
@@ -58,17 +93,26 @@ class CrosswordCreator():
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
+        # Font is fixed, so measure each distinct letter only once
+        metrics = {
+            letter: draw.textsize(letter, font=font)
+            for letter in string.ascii_uppercase
+        }
+
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
 
-                rect = [(j * cell_size + cell_border,
-                         i * cell_size + cell_border),
-                        ((j + 1) * cell_size - cell_border,
-                         (i + 1) * cell_size - cell_border)]
+                x, y = j * cell_size, i * cell_size
+                rect = [(x + cell_border, y + cell_border),
+                        (x + cell_size - cell_border,
+                         y + cell_size - cell_border)]
                 if self.crossword.structure[i][j]:
                     draw.rectangle(rect, fill="white")
                     if letters[i][j]:
-                        w, h = draw.textsize(letters[i][j], font=font)
+                        if letters[i][j] not in metrics:
+                            metrics[letters[i][j]] = draw.textsize(
+                                letters[i][j], font=font)
+                        w, h = metrics[letters[i][j]]
                         draw.text(
                             (rect[0][0] + ((interior_size - w) / 2),
                              rect[0][1] + ((interior_size - h) / 2) - 10),
@@ -82,9 +126,102 @@ class CrosswordCreator():
         """
         Enforce node and arc consistency, and then solve the CSP.
         """
-        self.enforce_node_consistency()
-        self.ac3()
-        return self.backtrack(dict())
+        # Domains are built node-consistent in __init__
+        if not self.ac3():
+            return None
+        # Initial pruning is never undone
+        self.trail.clear()
+
+        components = self.components()
+        if len(components) <= 1:
+            return self.backtrack(dict())
+
+        # Solve unconnected groups of variables in parallel
+        subproblems = [self.restrict(component) for component in components]
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(solve_subproblem, subproblems))
+        if any(result is None for result in results):
+            return None
+
+        # Words must be unique across groups too. Keep each group's
+        # result in turn, re-solving any group that reuses a word
+        solved = []
+        for component, result in zip(components, results):
+            group = set(component)
+            used = {word for part in solved for word in part.values()}
+            if not used.isdisjoint(result.values()):
+                # Try again without the words already taken
+                result = solve_subproblem(self.restrict(group, used))
+                while result is None:
+                    # Solve jointly with the groups holding words
+                    # this group could have used
+                    candidates = set().union(
+                        *(self.domains[var] for var in group))
+                    joined = [
+                        part for part in solved
+                        if not candidates.isdisjoint(part.values())
+                    ]
+                    # Excluded words were out of reach, so no solution
+                    if not joined:
+                        return None
+                    for part in joined:
+                        solved.remove(part)
+                        group.update(part)
+                    used = {word for part in solved for word in part.values()}
+                    result = solve_subproblem(self.restrict(group, used))
+            solved.append(result)
+
+        assignment = dict()
+        for part in solved:
+            assignment.update(part)
+        return assignment
+
+    def components(self):
+        """
+        Return a list of sets of variables, one per connected component
+        of the constraint graph.
+        """
+        parent = {var: var for var in self.crossword.variables}
+
+        def find(var):
+            while parent[var] != var:
+                parent[var] = parent[parent[var]]
+                var = parent[var]
+            return var
+
+        for var in self.crossword.variables:
+            for var_neighbor in self._neighbors[var]:
+                parent[find(var)] = find(var_neighbor)
+
+        components = defaultdict(set)
+        for var in self.crossword.variables:
+            components[find(var)].add(var)
+        return list(components.values())
+
+    def restrict(self, variables, excluded=()):
+        """
+        Return a new CrosswordCreator for only `variables`, which must be
+        closed under neighbors, starting from their current domains less
+        any `excluded` words.
+        """
+        domains = {
+            var: self.domains[var].difference(excluded) for var in variables
+        }
+
+        # Keep only this group's overlaps and words, so the creator
+        # stays small when sent to a worker process
+        crossword = copy.copy(self.crossword)
+        crossword.variables = set(variables)
+        crossword.overlaps = {
+            (v1, v2): self._overlap[v1, v2]
+            for v1 in variables for v2 in variables
+            if v1 != v2
+        }
+        crossword.words = set().union(*domains.values())
+
+        creator = CrosswordCreator(crossword)
+        creator.domains = domains
+        return creator
 
     def enforce_node_consistency(self):
         """
@@ -93,14 +230,12 @@ class CrosswordCreator():
          constraints; in this case, the length of the word.)
         """
         for var in self.domains:
-            var_len = var.length
-            words = self.domains[var]
-            copy = words.copy()
-
-            # Delete words that lengths don't match
-            for word in copy:
-                if len(word) != var_len:
-                    self.domains[var].remove(word)
+            # Keep only words whose length matches
+            self.domains[var] = {
+                word for word in self.domains[var] if len(word) == var.length
+            }
+            self._letter_index.pop(var, None)
+            self._dom_dirty.add(var)
 
     def revise(self, x, y):
         """
@@ -114,27 +249,93 @@ class CrosswordCreator():
         revision = False
 
         # Check if x and y overlaps
-        overlap = self.crossword.overlaps[x, y]
+        overlap = self._overlap[x, y]
         if overlap is None:
             return revision
 
         i, j = overlap
-        domain = self.domains[x]
-        d_copy = domain.copy()
-
-        for x_value in d_copy:
-            # check if y has valid value in its domain
-            check = False
-
-            for y_value in self.domains[y]:
-                # check if x_value and y_value are consistent
-                if x_value[i] == y_value[j]:
-                    check = True
-                    break
-            if not check:
-                self.domains[x].remove(x_value)
+
+        # Bind lookups to locals: this loop is the hottest in the solver
+        y_domain = self.domains[y]
+        y_letters = None
+        residual = self.residual.setdefault((x, y), dict())
+        get_residual = residual.get
+
+        # Collect x values with no consistent value in y's domain
+        to_remove = []
+
+        # If x's words are already grouped by letter, drop whole groups
+        # whose letter at the overlap no longer appears in y's words
+        x_index = self._letter_index.get(x)
+        if x_index is not None:
+            y_letters = self.letter_index(y)[j]
+            for letter, x_values in x_index[i].items():
+                if not y_letters.get(letter):
+                    to_remove.extend(x_values)
+        else:
+            # Otherwise check x's words one at a time
+            for x_value in self._iter_dom(x):
+                # Residual supports always match x_value at the overlap,
+                # so one still in y's domain is enough
+                if get_residual(x_value) in y_domain:
+                    continue
+
+                # Otherwise look for a new support among y's words
+                if y_letters is None:
+                    y_letters = self.letter_index(y)[j]
+                supports = y_letters.get(x_value[i])
+                if supports:
+                    residual[x_value] = next(iter(supports))
+                else:
+                    to_remove.append(x_value)
+
+        if to_remove:
+            self.prune(x, to_remove)
+            revision = True
         return revision
 
+    def prune(self, var, words):
+        """
+        Remove `words` from the domain of `var`, recording them on the trail.
+        """
+        self.domains[var].difference_update(words)
+        self.trail.extend((var, word) for word in words)
+        self._letter_index.pop(var, None)
+        self._dom_dirty.add(var)
+
+    def restore(self, checkpoint):
+        """
+        Undo every domain removal recorded on the trail after `checkpoint`.
+        """
+        while len(self.trail) > checkpoint:
+            var, word = self.trail.pop()
+            self.domains[var].add(word)
+            self._letter_index.pop(var, None)
+            self._dom_dirty.add(var)
+
+    def _iter_dom(self, var):
+        """
+        Return the domain of `var` as a tuple, for iteration.
+        """
+        if var in self._dom_dirty:
+            self._dom_cache[var] = tuple(self.domains[var])
+            self._dom_dirty.discard(var)
+        return self._dom_cache[var]
+
+    def letter_index(self, var):
+        """
+        Return a list with one dict per position of `var`, mapping each letter
+        to the set of words in `self.domains[var]` with that letter there.
+        """
+        index = self._letter_index.get(var)
+        if index is None:
+            index = [dict() for _ in range(var.length)]
+            for word in self._iter_dom(var):
+                for k in range(var.length):
+                    index[k].setdefault(word[k], set()).add(word)
+            self._letter_index[var] = index
+        return index
+
     def ac3(self, arcs=None):
         """
         Update `self.domains` such that each variable is arc consistent.
@@ -144,35 +345,44 @@ class CrosswordCreator():
         Return True if arc consistency is enforced and no domains are empty;
         return False if one or more domains end up empty.
         """
+        # FIFO queue of arcs, with a set tracking which arcs are queued
+        queue = deque()
+        in_queue = set()
         if arcs is None:
-            # create list of all arcs
-            arcs = []
+            # create queue of all arcs
             for var in self.crossword.variables:
-                var_neighbors = self.crossword.neighbors(var)
+                var_neighbors = self._neighbors[var]
 
                 for var_neighbor in var_neighbors:
                     arc_new = (var, var_neighbor)
 
-                    if arc_new not in arcs:
-                        arcs.append(arc_new)
-
-        while len(arcs) != 0:
-            x, y = arcs.pop()
+                    if arc_new not in in_queue:
+                        queue.append(arc_new)
+                        in_queue.add(arc_new)
+        else:
+            for arc in arcs:
+                if arc not in in_queue:
+                    queue.append(arc)
+                    in_queue.add(arc)
+
+        while queue:
+            x, y = queue.popleft()
+            in_queue.discard((x, y))
             # Update x
             revised = self.revise(x, y)
 
-            if not revised:
-                continue
-
-            # If arc consistency is not possible
-            if len(self.domains[x]) == 0:
-                return False
+            if revised:
+                # If arc consistency is not possible
+                if len(self.domains[x]) == 0:
+                    return False
 
-            for neighbor in self.crossword.neighbors(x):
-                if neighbor == y:
-                    continue
-                # Add neighbors affected by updating x
-                arcs.append((neighbor, x))
+                for neighbor in self._neighbors[x]:
+                    if neighbor == y:
+                        continue
+                    # Add neighbors affected by updating x
+                    if (neighbor, x) not in in_queue:
+                        queue.append((neighbor, x))
+                        in_queue.add((neighbor, x))
         return True
 
     def assignment_complete(self, assignment):
@@ -191,29 +401,43 @@ class CrosswordCreator():
         puzzle without conflicting characters); return False otherwise.
         """
         # Check all words unique
-        for word1 in assignment:
-            for word2 in assignment:
-                if word1 == word2:
-                    continue
-                if assignment[word1] == assignment[word2]:
-                    return False
+        values = list(assignment.values())
+        if len(set(values)) != len(values):
+            return False
 
-        # Check all variables and words same length
-        for word in assignment:
-            if word.length != len(assignment[word]):
-                return False
+        # Word lengths already match thanks to node consistency
 
         # Check consistency between overlapped variables
         for var in assignment:
-            var_neighbors = self.crossword.neighbors(var)
+            var_neighbors = self._neighbors[var]
             for var_neighbor in var_neighbors:
                 if var_neighbor not in assignment:
                     continue
-                i, j = self.crossword.overlaps[var, var_neighbor]
+                i, j = self._overlap[var, var_neighbor]
                 if assignment[var][i] != assignment[var_neighbor][j]:
                     return False
         return True
 
+    def consistent_with(self, var, value, assignment):
+        """
+        Return True if assigning `value` to `var` is consistent with the
+        already consistent `assignment`; return False otherwise.
+        """
+        # Word must not be used elsewhere
+        if value in assignment.values():
+            self.conf_set.setdefault(var, set()).update(
+                other for other in assignment if assignment[other] == value
+            )
+            return False
+
+        # Only overlaps with assigned neighbors can conflict
+        for var_neighbor in self._neighbors[var] & assignment.keys():
+            i, j = self._overlap[var, var_neighbor]
+            if value[i] != assignment[var_neighbor][j]:
+                self.conf_set.setdefault(var, set()).add(var_neighbor)
+                return False
+        return True
+
     def order_domain_values(self, var, assignment):
         """
         Return a list of values in the domain of `var`, in order by
@@ -221,45 +445,28 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        #  Dict of domain values as keys and number of values ruled out as keys' value
-        order_dict = {}
-
-        domain_values = self.domains[var]
-        var_neighbors = self.crossword.neighbors(var)
-
-        for value in domain_values:
-            n = 0
-            for var_neighbor in var_neighbors:
-                # Skip if neighbor value already exsit
-                if var_neighbor in assignment:
-                    continue
-
-                var_neighbor_domain = self.domains[var_neighbor]
-                for neighbor_value in var_neighbor_domain:
-                    # Remove equal values
-                    if value == neighbor_value:
-                        n += 1
-                        continue
-
-                    overlap = self.crossword.overlaps[var, var_neighbor]
-                    if overlap is None:
-                        continue
-                    i, j = overlap
-                    # Remove non-consistent overlap values
-                    if value[i] != neighbor_value[j]:
-                        n += 1
-            order_dict[value] = n
-        # Sort dictionary by its values
-        order_dict = {
-            k: v
-            for k, v in sorted(order_dict.items(), key=lambda item: item[1])
-        }
-
-        # Get key from sorted dict
-        list_key = list()
-        for key in order_dict.keys():
-            list_key.append(key)
-        return list_key
+        # For each unassigned neighbor, its words grouped by the letter
+        # at the overlap, alongside its domain size
+        neighbor_letters = []
+        for var_neighbor in self._neighbors[var]:
+            # Skip if neighbor value already exsit
+            if var_neighbor in assignment:
+                continue
+            i, j = self._overlap[var, var_neighbor]
+            neighbor_letters.append((
+                i,
+                self.letter_index(var_neighbor)[j],
+                len(self.domains[var_neighbor])
+            ))
+
+        def conflicts(value):
+            # Neighbor values that disagree with value at the overlap
+            return sum(
+                size - len(letters.get(value[i], ()))
+                for i, letters, size in neighbor_letters
+            )
+
+        return sorted(self._iter_dom(var), key=conflicts)
 
     def select_unassigned_variable(self, assignment):
         """
@@ -269,28 +476,16 @@ class CrosswordCreator():
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
         """
-        total = self.crossword.variables
-        assigned = set(assignment.keys())
-        unassigned = total - assigned
-        # list of variables with minimum values in domain
-        min_var = []
-        min_var.append(next(iter(unassigned)))
-
-        for var in unassigned:
-            if len(self.domains[var]) < len(self.domains[min_var[0]]):
-                min_var = []
-                min_var.append(var)
-            if len(self.domains[var]) == len(self.domains[min_var[0]]):
-                min_var.append(var)
-
-        # Keep track of variable in min_var with max degree
-        max_degree = len(self.crossword.neighbors(min_var[0]))
-        max_degree_var = min_var[0]
-        for var in min_var:
-            if len(self.crossword.neighbors(var)) > max_degree:
-                max_degree = len(self.crossword.neighbors(var))
-                max_degree_var = var
-        return max_degree_var
+        unassigned = self.crossword.variables - assignment.keys()
+
+        # Fewest remaining values first, then highest degree
+        return min(
+            unassigned,
+            key=lambda var: (
+                len(self.domains[var]),
+                -len(self._neighbors[var])
+            )
+        )
 
     def backtrack(self, assignment):
         """
@@ -301,23 +496,82 @@ class CrosswordCreator():
 
         If no assignment is possible, return None.
         """
+        result, _ = self.backjump(assignment)
+        return result
+
+    def backjump(self, assignment):
+        """
+        Backtracking search with conflict-directed backjumping.
+
+        Return a tuple `(result, conflicts)`. On success, `result` is a
+        complete assignment. On failure, `result` is None and `conflicts` is
+        the set of assigned variables that caused it; the search jumps back
+        to the most recently assigned of them, skipping every frame in
+        between.
+        """
         if self.assignment_complete(assignment):
-            return assignment
+            return assignment, set()
 
         # Select unassigned variable
         var = self.select_unassigned_variable(assignment)
+
+        # Values already pruned from var's domain count as conflicts with
+        # every assignment that pruned any domain, since propagation can
+        # reach var through other variables
+        self.conf_set[var] = self.pruners()
+
         for value in self.order_domain_values(var, assignment):
-            assi_copy = assignment.copy()
-            assi_copy.update({var: value})
-            consistency = self.consistent(assi_copy)
-            if consistency:
-                assignment.update({var: value})
-                result = self.backtrack(assignment)
+            if not self.consistent_with(var, value, assignment):
+                continue
+
+            assignment.update({var: value})
+            checkpoint = len(self.trail)
+
+            # Maintain arc consistency around the new assignment
+            self.prune(var, list(self.domains[var] - {value}))
+            arcs = [
+                (var_neighbor, var)
+                for var_neighbor in self._neighbors[var]
+            ]
+            conflicts = None
+            if self.ac3(arcs):
+                self.segments.append((var, len(self.trail) > checkpoint))
+                result, conflicts = self.backjump(assignment)
                 if result is not None:
-                    return result
-                else:
-                    assignment.pop(var)
-        return None
+                    return result, set()
+                self.segments.pop()
+
+            self.restore(checkpoint)
+            assignment.pop(var)
+
+            if conflicts is None:
+                # Propagation wiped out a domain: blame every earlier
+                # assignment that pruned any domain
+                self.conf_set[var].update(self.pruners())
+            elif var in conflicts:
+                # var is the most recent culprit, so try its next value
+                self.conf_set[var].update(conflicts - {var})
+            else:
+                # Failure is independent of var: jump past it
+                del self.conf_set[var]
+                return None, conflicts
+
+        return None, self.conf_set.pop(var)
+
+    def pruners(self):
+        """
+        Return the assigned variables whose propagation removed values from
+        any domain.
+        """
+        return {owner for owner, pruned in self.segments if pruned}
+
+
+def solve_subproblem(creator):
+    """
+    Run backtracking search on a restricted CrosswordCreator.
+    Defined at module level so it can be sent to worker processes.
+    """
+    return creator.backtrack(dict())
 
 
 def main():
@@ -340,9 +594,10 @@ def main():
     if assignment is None:
         print("No solution.")
     else:
-        creator.print(assignment)
+        letters = creator.letter_grid(assignment)
+        creator.print(letters)
         if output:
-            creator.save(assignment, output)
+            creator.save(letters, output)
 
 
 if __name__ == "__main__":